@@ -13,13 +13,26 @@ License: GPLv2+
 """
 import sys
 import getopt
+import logging
 import datetime as dt
+import io
+import json
 import time
-import requests
-import bs4
+import aiohttp
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from lxml import etree
 import asyncio
+import concurrent.futures
+import multiprocessing
 import pprint
-from typing import Dict
+import re
+import sqlite3
+from typing import Dict, List, Optional, Pattern, Set
+try:
+    # orjson is faster, but not available on PyPy
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 # General use global variables
@@ -27,6 +40,36 @@ RFC_EDITOR_URL = 'https://www.rfc-editor.org'
 DATA_TRACKER_URL = 'https://datatracker.ietf.org'
 OPTIONS = 'hvdn:'
 LONG_OPTIONS = ['help', 'verbose', 'debug', 'name']
+# Connection pool limits for the shared HTTP session
+CONNECTION_LIMIT = 50
+CONNECTION_LIMIT_PER_HOST = 25
+DNS_CACHE_TTL = 300
+# Maximum number of RFCs checked concurrently
+MAX_CONCURRENT_CHECKS = 15
+# Persistent HTTP cache. Published RFCs do not change, ballot pages, the
+# RFC index and datatracker API queries may.
+CACHE_FILE = 'ietf-info-cache.sqlite'
+CACHE_NEVER_EXPIRE = -1
+CACHE_EXPIRE_AFTER = dt.timedelta(days=1)
+CACHE_URLS_EXPIRE_AFTER = {
+    'www.rfc-editor.org/rfc/': CACHE_NEVER_EXPIRE,
+    'datatracker.ietf.org/doc/rfc*/ballot/': dt.timedelta(days=30),
+}
+# Only RFCs from these streams go through an IESG ballot
+BALLOT_STREAMS = ['IETF']
+# Checkpoint of RFCs already checked, so an interrupted run can resume
+CHECKPOINT_FILE = 'ietf-info-checkpoint.sqlite'
+CHECKPOINT_HITS = ['acknowledged', 'balloted', 'discussed']
+# Translation table removing parentheses from RFC index lines
+DROP_PARENS = str.maketrans('', '', '()')
+# Datatracker API paging and document URI parsing
+API_PAGE_SIZE = 500
+RFC_URI_REGEX = re.compile(r'/rfc(\d+)/$')
+# Ballot page markup following a balloter's name whose position was Discuss
+DISCUSS_SUFFIX = (
+    r'\s*</div>\s*<div class="flex-fill text-end">'
+    r'\s*<span class="text-muted small">\(was Discuss\)'
+)
 USAGE = f"""
 Tool for counting RFC contributions by name.
 
@@ -48,6 +91,8 @@ INCLUDE = [
     'ACKNOWLEDGMENTS',
 ]
 NAME = ''
+NAME_BYTES = b''
+DISCUSS_RE: Optional[Pattern[bytes]] = None
 FIRST_YEAR = 2022
 LAST_YEAR = dt.date.today().year
 FIRST_RFC = 7000
@@ -62,24 +107,29 @@ SHEPHERD: Dict[int, str] = {}
 CONTRIBUTOR: Dict[int, str] = {}
 BALLOTED: Dict[int, str] = {}
 DISCUSS: Dict[int, str] = {}
-FAILED_CHECK: Dict[int, str] = {}
+UNCHECKED: Dict[int, str] = {}
 
+LOGGER = logging.getLogger('ietf-info')
 
-def parse_rfc_row(row: bs4.element.Tag) -> dict:
+# Shared HTTP session and checkpoint database, created in main()
+SESSION: Optional[aiohttp.ClientSession] = None
+CHECKPOINT: Optional[sqlite3.Connection] = None
+
+
+def parse_rfc_row(row: etree._Element) -> dict:
     """Parse a row of rfc table into a dict."""
     fields = {}
-    fields['number'] = int(row.td.noscript.get_text())
-    fields['title'] = row.td.find_next_sibling('td').b.get_text()
-    text = row.td.find_next_sibling('td').get_text()
+    fields['number'] = int(row.xpath('./td/noscript/text()')[0])
+    details = row.xpath('./td[2]')[0]
+    fields['title'] = details.xpath('string(b)')
+    text = details.xpath('string()')
     fields['issued'] = 'Not issued' not in text
-    lines = [line.strip() for line in text.splitlines() if
-             line.strip() != '']
+    lines = [line for line in map(str.strip, text.splitlines()) if line]
     for line in lines[1:]:
         if '[' in line:
             fields['year'] = int(line.split()[-2])
         elif ':' in line:
-            line = line.replace('(', '')
-            line = line.replace(')', '')
+            line = line.translate(DROP_PARENS)
             parts = line.split(', ')
             for part in parts:
                 key_val_pair = part.split(': ')
@@ -87,11 +137,8 @@ def parse_rfc_row(row: bs4.element.Tag) -> dict:
     return fields
 
 
-def validate_row(row: bs4.element.Tag) -> bool:
-    """Tell filtering function if the row should be included."""
-    if row.name != 'tr' or row.td.noscript is None:
-        return False
-    row = parse_rfc_row(row)
+def validate_row(row: dict) -> bool:
+    """Tell filtering function if the parsed row should be included."""
     return (
         row['status'] in INCLUDE
         and row['issued']
@@ -100,6 +147,39 @@ def validate_row(row: bs4.element.Tag) -> bool:
     )
 
 
+def parse_rfc_index(content: bytes) -> list:
+    """Parse all RFC rows of the RFC index page into dicts."""
+    rows = []
+    siblings = None
+    tables_seen = 0
+    target = None
+    # RFC entries are the numbered rows of the third table counting the
+    # first table and its siblings. Parse incrementally and drop each row
+    # once handled, so the full document tree is never built.
+    for event, elem in etree.iterparse(io.BytesIO(content),
+                                       events=('start', 'end'),
+                                       tag=('tr', 'table'), html=True):
+        if elem.tag == 'table':
+            if siblings is None:
+                siblings = elem.getparent()
+            if elem.getparent() is not siblings:
+                continue
+            if event == 'start' and tables_seen == 2:
+                target = elem
+            elif event == 'end':
+                if elem is target:
+                    break
+                tables_seen += 1
+        elif event == 'end':
+            if (elem.getparent() is target
+                    and elem.find('./td/noscript') is not None):
+                rows.append(parse_rfc_row(elem))
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    return rows
+
+
 def handle_arguments(arglist) -> None:
     """Parse given arguments and handle."""
     arguments, _ = getopt.getopt(arglist, OPTIONS, LONG_OPTIONS)
@@ -123,6 +203,10 @@ def handle_arguments(arglist) -> None:
             VERBOSE = True
     if not NAME:
         sys.exit()
+    global NAME_BYTES
+    NAME_BYTES = NAME.encode()
+    global DISCUSS_RE
+    DISCUSS_RE = re.compile(re.escape(NAME_BYTES) + DISCUSS_SUFFIX.encode())
 
 
 def print_result() -> None:
@@ -142,14 +226,18 @@ def print_result() -> None:
     print(f'Balloted: {len(BALLOTED)}')
     if VERBOSE:
         pprint.pprint(BALLOTED)
+    print(f'Discussed: {len(DISCUSS)}')
+    if VERBOSE:
+        pprint.pprint(DISCUSS)
     print(f'Acknowledged: {len(CONTRIBUTOR)}')
     if VERBOSE:
         pprint.pprint(CONTRIBUTOR)
-
-
-async def http_get(url: str) -> requests.models.Response:
-    """Async http get function."""
-    return await asyncio.to_thread(requests.get, url)
+    if UNCHECKED:
+        print()
+        print(f'Not checked due to errors, retried on next run: '
+              f'{len(UNCHECKED)}')
+        if VERBOSE:
+            pprint.pprint(UNCHECKED)
 
 
 async def get_possible_rfcs() -> list:
@@ -157,127 +245,290 @@ async def get_possible_rfcs() -> list:
     route = '/rfc-index2.html'
 
     try:
-        if DEBUG:
-            print(
-                f'Requesting data from {RFC_EDITOR_URL + route}... ',
-                end=''
-            )
-        response = await http_get(RFC_EDITOR_URL + route)
-    except requests.exceptions.ConnectionError as error:
+        LOGGER.debug('Requesting data from %s', RFC_EDITOR_URL + route)
+        async with SESSION.get(RFC_EDITOR_URL + route) as response:
+            content = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
         print(f'Aborted due to the following error:\n{error}')
         sys.exit()
 
-    soup = bs4.BeautifulSoup(response.content, 'html.parser')
-    table = soup.table
+    # Parsing is CPU bound, keep it off the event loop so the datatracker
+    # role lookups can proceed meanwhile. Filtering stays here as it
+    # depends on the commandline arguments. The worker is spawned rather
+    # than forked, as the HTTP cache runs its own thread by now.
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        rows = await loop.run_in_executor(executor, parse_rfc_index, content)
+
+    return [row for row in rows if validate_row(row)]
+
+
+async def get_api_objects(route: str, params: dict) -> list:
+    """Get all objects of a paginated datatracker API query."""
+    objects = []
+    url = DATA_TRACKER_URL + route
+    params = {**params, 'format': 'json', 'limit': API_PAGE_SIZE}
+    while True:
+        try:
+            LOGGER.debug('Requesting data from %s', url)
+            async with SESSION.get(url, params=params) as response:
+                data = json_loads(await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                json.JSONDecodeError) as error:
+            LOGGER.warning('get_api_objects failed with %s', error)
+            return objects
+        if not isinstance(data, dict) or 'objects' not in data:
+            # e.g. tastypie's {"error": ...} for an unsupported filter
+            LOGGER.warning('get_api_objects failed with %s', data)
+            return objects
+        objects.extend(data['objects'])
+        next_page = data.get('meta', {}).get('next')
+        if not next_page:
+            break
+        # The next page URL already carries the query parameters
+        url = DATA_TRACKER_URL + next_page
+        params = None
+    return objects
+
+
+def rfc_number_from_uri(uri: str) -> Optional[int]:
+    """Return the RFC number of a datatracker document URI, if any."""
+    match = RFC_URI_REGEX.search(uri)
+    return int(match.group(1)) if match else None
+
+
+async def get_person_roles() -> Dict[str, Set[int]]:
+    """Look up RFCs the name authored, shepherded or was responsible AD for.
+
+    Uses the datatracker API to query by person instead of fetching the
+    metadata of every RFC. Does not need the RFC index, so it can run
+    while the index is being parsed.
+    """
+    roles: Dict[str, Set[int]] = {
+        'authored': set(),
+        'shepherded': set(),
+        'responsible_ad': set(),
+    }
+    # Exact name match, a substring match would also count other people
+    people = await get_api_objects('/api/v1/person/person/', {'name': NAME})
+    for person in people:
+        person_id = person['id']
+        # The role queries are independent, run them together
+        authored, shepherded, responsible = await asyncio.gather(
+            get_api_objects(
+                '/api/v1/doc/documentauthor/',
+                {'person': person_id, 'document__type': 'rfc'},
+            ),
+            get_api_objects(
+                '/api/v1/doc/document/',
+                {'shepherd__person': person_id, 'type': 'rfc'},
+            ),
+            get_api_objects(
+                '/api/v1/doc/document/',
+                {'ad': person_id, 'type': 'rfc'},
+            ),
+        )
+        for role, uris in (
+                ('authored', [author['document'] for author in authored]),
+                ('shepherded', [doc['resource_uri'] for doc in shepherded]),
+                ('responsible_ad',
+                 [doc['resource_uri'] for doc in responsible]),
+        ):
+            numbers = map(rfc_number_from_uri, uris)
+            roles[role].update(
+                number for number in numbers if number is not None
+            )
+    return roles
+
+
+def open_checkpoint() -> sqlite3.Connection:
+    """Open the checkpoint database, creating it if needed."""
+    connection = sqlite3.connect(CHECKPOINT_FILE, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS processed ('
+        'name TEXT, rfc_number INTEGER, processed_at TEXT, '
+        'acknowledged INTEGER, balloted INTEGER, discussed INTEGER, '
+        'PRIMARY KEY (name, rfc_number))'
+    )
+    return connection
 
-    # Find correct table
-    for _ in range(2):
-        table = table.find_next_sibling('table')
 
-    return [parse_rfc_row(row) for row in table.contents
-            if validate_row(row)]
+def load_checkpoint() -> Dict[int, List[str]]:
+    """Return the hits of RFCs already checked for name."""
+    cursor = CHECKPOINT.execute(
+        f'SELECT rfc_number, {", ".join(CHECKPOINT_HITS)} FROM processed '
+        'WHERE name = ?',
+        (NAME,),
+    )
+    return {
+        number: [hit for hit, flag in zip(CHECKPOINT_HITS, flags) if flag]
+        for number, *flags in cursor
+    }
+
+
+def record_checkpoint(rfc: dict, hits: List[str]) -> None:
+    """Store the hits of a fully checked RFC."""
+    CHECKPOINT.execute(
+        'INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?)',
+        (
+            NAME,
+            rfc['number'],
+            dt.datetime.now().isoformat(),
+            *[hit in hits for hit in CHECKPOINT_HITS],
+        ),
+    )
 
 
-async def check_rfc(rfc: dict) -> None:
-    """Check RFC for name match, and add hits to statistics."""
-    route = f'/doc/rfc{rfc["number"]}/doc.json'
-    try:
-        if DEBUG:
-            print(f'{rfc["number"]}: Getting rfc data... ', end='')
-        response = await http_get(DATA_TRACKER_URL + route)
-    except requests.exceptions.ConnectionError as error:
-        print(f'check_rfc failed with {error}')
-        return
-    datatracker_metadata = response.json()
-    # print(datatracker_metadata['authors'])
-    if NAME in datatracker_metadata['authors']:
-        AUTHOR[rfc['number']] = rfc['title']
-        if VERBOSE:
-            print(f'{rfc["number"]}: Authored')
-    # print(datatracker_metadata['shepherd'])
-    if (
-            datatracker_metadata['shepherd']
-            and NAME in datatracker_metadata['shepherd']
-    ):
-        SHEPHERD[rfc['number']] = rfc['title']
-        if VERBOSE:
-            print(f'{rfc["number"]}Shepherded')
-    if DEBUG:
-        print(datatracker_metadata['ad'])
-    if (
-            datatracker_metadata['ad']
-            and NAME in datatracker_metadata['ad']
-    ):
-        RESPONSIBLE_AD[rfc['number']] = rfc['title']
-        if VERBOSE:
-            print(f'{rfc["number"]}: Responsible AD')
+async def check_rfc(rfc: dict) -> List[str]:
+    """Check RFC text and ballot for name match, and return the hits.
+
+    The RFC is recorded in the checkpoint unless one of the checks failed.
+    """
+    # The checks hit different hosts and are independent, run them together
+    checks = []
+    if rfc.get('stream') in BALLOT_STREAMS:
+        checks.append(check_ballot(rfc))
     if 'ACKNOWLEDGMENTS' in INCLUDE:
-        result = await check_acknowledgments(rfc)
-    result = await check_ballot(rfc)
-    if not result:
-        print(f'{rfc["number"]}: Name not found')
+        checks.append(check_acknowledgments(rfc))
+    results = await asyncio.gather(*checks)
+    hits = [hit for hits in results if hits is not None for hit in hits]
+    if None not in results:
+        record_checkpoint(rfc, hits)
+    return hits
 
 
-async def check_acknowledgments(rfc: dict) -> bool:
+async def check_acknowledgments(rfc: dict) -> Optional[List[str]]:
     """Check the RFC text for name as an acknowledgment."""
     route = f'/rfc/rfc{rfc["number"]}.txt'
     try:
-        if DEBUG:
-            print(f'{rfc["number"]}: Getting acknowledgment data... ', end='')
-        response = await http_get(RFC_EDITOR_URL + route)
-    except requests.exceptions.ConnectionError as error:
-        print(f'check_acknowledgments failed with {error}')
-        return False
-    try:
-        rfc_text = response.content.decode()
-    except UnicodeDecodeError:
-        try:
-            rfc_text = response.content.decode('latin-1')
-        except UnicodeDecodeError as error:
-            FAILED_CHECK[rfc['number']] = rfc['title']
-            print(error)
-    if rfc_text and NAME in rfc_text:
-        CONTRIBUTOR[rfc['number']] = rfc['title']
-        if VERBOSE:
-            print(f'{rfc["number"]}: Contributed')
-        return True
-    return False
-
-
-async def check_ballot(rfc: dict) -> bool:
-    """Check if the RFC is balloted."""
+        LOGGER.debug('%d: Getting acknowledgment data', rfc['number'])
+        async with SESSION.get(RFC_EDITOR_URL + route) as response:
+            status = response.status
+            content = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        LOGGER.warning('%d: check_acknowledgments failed with %s',
+                       rfc['number'], error)
+        return None
+    if status != 200:
+        # Not a result, e.g. rate limited, so leave it for the next run
+        LOGGER.warning('%d: check_acknowledgments failed with HTTP %d',
+                       rfc['number'], status)
+        return None
+    if NAME_BYTES in content:
+        LOGGER.info('%d: Contributed', rfc['number'])
+        return ['acknowledged']
+    return []
+
+
+async def check_ballot(rfc: dict) -> Optional[List[str]]:
+    """Check if the RFC is balloted, and if so whether it was discussed."""
     route = f'/doc/rfc{rfc["number"]}/ballot/'
     try:
-        if DEBUG:
-            print(f'{rfc["number"]}: Getting ballot data... ', end='')
-        response = await http_get(DATA_TRACKER_URL + route)
-    except requests.exceptions.ConnectionError as error:
-        print(f'check_ballot failed with {error}')
-        return False
-    try:
-        rfc_text = response.content.decode()
-    except UnicodeDecodeError:
-        try:
-            rfc_text = response.content.decode('latin-1')
-        except UnicodeDecodeError as error:
-            FAILED_CHECK[rfc['number']] = rfc['title']
-            print(error)
-    if NAME in rfc_text:
-        BALLOTED[rfc['number']] = rfc['title']
-        if VERBOSE:
-            print(f'{rfc["number"]}: Balloted')
-        return True
-    return False
+        LOGGER.debug('%d: Getting ballot data', rfc['number'])
+        async with SESSION.get(DATA_TRACKER_URL + route) as response:
+            status = response.status
+            content = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        LOGGER.warning('%d: check_ballot failed with %s',
+                       rfc['number'], error)
+        return None
+    if status == 404:
+        # The RFC has no ballot
+        return []
+    if status != 200:
+        # Not a result, e.g. rate limited, so leave it for the next run
+        LOGGER.warning('%d: check_ballot failed with HTTP %d',
+                       rfc['number'], status)
+        return None
+    start = content.find(NAME_BYTES)
+    if start == -1:
+        return []
+    LOGGER.info('%d: Balloted', rfc['number'])
+    # Only look for a Discuss position once the name is known to be there
+    if DISCUSS_RE.search(content, start):
+        LOGGER.info('%d: Discussed', rfc['number'])
+        return ['balloted', 'discussed']
+    return ['balloted']
+
+
+async def bounded(semaphore: asyncio.Semaphore, coro):
+    """Await coroutine while holding the semaphore."""
+    async with semaphore:
+        return await coro
 
 
 async def main() -> None:
     """Execute main program."""
     start = time.time()
     handle_arguments(sys.argv[1:])
-    table = await get_possible_rfcs()
     if DEBUG:
-        print('Started going through RFC:s left after filtering')
-    await asyncio.gather(*[check_rfc(rfc) for rfc in table])
+        log_level = logging.DEBUG
+    elif VERBOSE:
+        log_level = logging.INFO
+    else:
+        log_level = logging.WARNING
+    # Only this script's logger follows -d/-v, libraries stay at WARNING
+    logging.basicConfig(format='%(message)s')
+    LOGGER.setLevel(log_level)
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+    cache = SQLiteBackend(
+        CACHE_FILE,
+        expire_after=CACHE_EXPIRE_AFTER,
+        urls_expire_after=CACHE_URLS_EXPIRE_AFTER,
+    )
+    global CHECKPOINT
+    CHECKPOINT = open_checkpoint()
+    checked = load_checkpoint()
+    global SESSION
+    async with CachedSession(cache=cache, connector=connector) as SESSION:
+        # The role lookups only need the name, overlap them with the
+        # index download and parse
+        LOGGER.debug('Looking up datatracker roles for name')
+        table, roles = await asyncio.gather(
+            get_possible_rfcs(), get_person_roles()
+        )
+        for rfc in table:
+            if rfc['number'] in roles['authored']:
+                AUTHOR[rfc['number']] = rfc['title']
+                LOGGER.info('%d: Authored', rfc['number'])
+            if rfc['number'] in roles['shepherded']:
+                SHEPHERD[rfc['number']] = rfc['title']
+                LOGGER.info('%d: Shepherded', rfc['number'])
+            if rfc['number'] in roles['responsible_ad']:
+                RESPONSIBLE_AD[rfc['number']] = rfc['title']
+                LOGGER.info('%d: Responsible AD', rfc['number'])
+        unchecked = [rfc for rfc in table if rfc['number'] not in checked]
+        LOGGER.debug('Skipping %d RFC:s already checked',
+                     len(table) - len(unchecked))
+        LOGGER.debug('Started going through RFC:s left after filtering')
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+        results = await asyncio.gather(
+            *[bounded(semaphore, check_rfc(rfc)) for rfc in unchecked]
+        )
+    # RFCs with a failed check are not in the checkpoint
+    recorded = load_checkpoint()
+    CHECKPOINT.close()
+    for rfc in unchecked:
+        if rfc['number'] not in recorded:
+            UNCHECKED[rfc['number']] = rfc['title']
+    checked.update(
+        (rfc['number'], hits) for rfc, hits in zip(unchecked, results)
+    )
+    collectors = {
+        'acknowledged': CONTRIBUTOR,
+        'balloted': BALLOTED,
+        'discussed': DISCUSS,
+    }
+    for rfc in table:
+        for hit in checked.get(rfc['number'], []):
+            collectors[hit][rfc['number']] = rfc['title']
     print_result()
     print(f'finished in {time.time() - start}')
 